@@ -1,28 +1,27 @@
 from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
-from typing import IO, TextIO
+from typing import TYPE_CHECKING, TextIO
 
 import argparse
+import functools
+import operator
+import os
 import re
-import subprocess
 import sys
 import threading
+import time
 
-import pyperclip
-from termcolor import colored
+if TYPE_CHECKING:
+    import sqlite3
 
-try:
-    import ollama
-except ImportError:
-    exit("Install `ollama-python` by following the instruction on: https://github.com/ollama/ollama-python")
-
-
-import pkg_resources
-
-_version = pkg_resources.get_distribution("clicra").version
 
 DEFAULT_LLM = "llama3"
 LARGER_LLM = "llama3:70b"
 DEFAULT_OUTPUT_MAX_CHARS = 2000
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "clicra")
+CACHE_PATH = os.path.join(CACHE_DIR, "cache.sqlite")
+DEFAULT_CACHE_TTL = 7 * 24 * 60 * 60
+CACHED_CHAT_OPTIONS = {"temperature": 0}
+DEFAULT_REFER_TTL = 0
 
 PROMPTINGS : Dict[str, str] = {
     "sbs": """(Let’s work this out in a step by step way to be sure we have the right answer.
@@ -34,159 +33,407 @@ Then all experts will go on to the next step, etc. If any expert realises they'r
 """,  # ref: https://github.com/dave1010/tree-of-thought-prompting
 }
 
+PROMPT_COMMAND_REQUEST = "Please provide a command line to accomplish the following task."
+PROMPT_SCRIPT_REQUEST = "Please provide a script to accomplish the following task."
+PROMPT_ANALYSIS_REQUEST = "Analyze the result of the command.\n"
+PROMPT_TASK_HEADER = "\n## TASK\n"
+PROMPT_CONTEXT_HEADER = "\n## CONTEXT\n"
+PROMPT_COMMAND_HEADER = "\n## COMMAND\n```\n"
+PROMPT_STDOUT_HEADER = "\n## STDOUT\n"
+PROMPT_STDERR_HEADER = "\n## STDERR\n"
 
-def clip_text(text: str, max_chars: int) -> str:
-    if len(text) == 0:
-        return "\n"
 
-    snip_str = " ...(snip)... "
+def use_color(stream: TextIO) -> bool:
+    if os.environ.get("NO_COLOR"):
+        return False
+    if "FORCE_COLOR" in os.environ:
+        return True
+    return stream.isatty()
 
-    newline_pos = text.find("\n")
-    if newline_pos < 0 or newline_pos > max_chars:
-        return text[:max_chars] + snip_str + "\n"
-
-    while newline_pos >= 0:
-        next_newline_pos = text.find("\n", newline_pos + 1)
-        if next_newline_pos < 0 or next_newline_pos > max_chars:
-            return text[: newline_pos + 1] + snip_str + "\n"
-        newline_pos = next_newline_pos
 
-    if not text.endswith("\n"):
-        text = text + "\n"
+def no_color(text: str, *args, **kwargs) -> str:
     return text
 
 
-def stream_reader(stream: IO, output: TextIO, output_list: List[str]) -> None:
-    for line in iter(stream.readline, b""):
-        line = line.decode("utf-8")
-        output_list.append(line)
+def color_affixes(colored: Callable[..., str], *args, **kwargs) -> Tuple[str, str]:
+    """Return the strings `colored` puts before and after a text, to apply the same style without calling it per line."""
 
+    prefix, suffix = colored("\0", *args, **kwargs).split("\0")
+    return prefix, suffix
 
-def stream_reader_thru(stream: IO, output: TextIO, output_list: List[str]) -> None:
-    for line in iter(stream.readline, b""):
-        line = line.decode("utf-8")
-        output_list.append(line)
-        print(line, file=output, end="")
 
+def print_prompt(prompt: str, colored: Callable[..., str]) -> None:
+    prefix, suffix = color_affixes(colored, attrs=["dark"])
+    sys.stderr.write("".join(prefix + L + suffix + "\n" for L in prompt.split("\n")))
 
-def do_run_and_capture(code: str, thru_output=True) -> Tuple[int, str, str]:
-    """Run the code and capture the standard out and standard error."""
 
-    lines = []
-    for L in code.split("\n"):
-        if L.startswith("$ "):
-            L = L[2:]
-        lines.append(L)
+class VersionAction(argparse.Action):
+    """Like argparse's "version" action, but looks up the installed version only when the option is given."""
 
-    process = subprocess.Popen(["bash", "-c", "\n".join(lines)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
 
-    stdout_list = []
-    stderr_list = []
+    def __call__(self, parser, namespace, values, option_string=None):
+        from importlib.metadata import PackageNotFoundError, version
 
-    sr = stream_reader_thru if thru_output else stream_reader
+        try:
+            v = version("clicra")
+        except PackageNotFoundError:  # e.g., clicra.py run directly from a source tree
+            v = "(unknown version, not installed)"
+        print(f"{parser.prog} {v}")
+        parser.exit()
 
-    stdout_thread = threading.Thread(target=sr, args=(process.stdout, sys.stdout, stdout_list))
-    stderr_thread = threading.Thread(target=sr, args=(process.stderr, sys.stderr, stderr_list))
 
-    stdout_thread.start()
-    stderr_thread.start()
+def clip_text(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text if text.endswith("\n") else text + "\n"
 
-    process.wait()
+    snip_str = " ...(snip)... "
 
-    stdout_thread.join()
-    stderr_thread.join()
+    cut = text.rfind("\n", 0, max_chars)
+    if cut < 0:
+        return text[:max_chars] + snip_str + "\n"
+    return text[: cut + 1] + snip_str + "\n"
+
+
+PIPE_READ_SIZE = 65536
+SHELL_PROMPT_PATTERN = re.compile(r"^\$ ", re.MULTILINE)
+SHELL_SPECIAL_CHARS = frozenset(";|&<>`$*?(){}[]\\\n\"'~#")
+# bash keywords and builtins; these behave differently from (or do not exist as) executables on PATH
+SHELL_BUILTIN_NAMES = frozenset(
+    "! . : [ [[ ]] { } alias bg bind break builtin caller case cd command compgen complete compopt continue coproc "
+    "declare dirs disown do done echo elif else enable esac eval exec exit export false fc fg fi for function getopts "
+    "hash help history if in jobs kill let local logout mapfile popd printf pushd pwd read readarray readonly return "
+    "select set shift shopt source suspend test then time times trap true type typeset ulimit umask unalias unset "
+    "until wait while".split()
+)
+
+
+def write_thru(output: TextIO, data: bytes) -> None:
+    output.buffer.write(data)
+    output.buffer.flush()
+
+
+def decode_output(data: bytes, truncated: bool = False) -> str:
+    """Decode the whole captured output of a stream at once."""
+
+    text = data.decode("utf-8", "replace")
+    return text if truncated else text.rstrip()  # whitespace at the cut point is not trailing
+
+
+def command_argv(script: str) -> List[str]:
+    """Return the argv to run the script, skipping bash when it is a single command without any shell syntax."""
+
+    import shutil
+
+    if SHELL_SPECIAL_CHARS.isdisjoint(script):
+        argv = script.split()
+        # builtins such as `cd` or `time`, or `VAR=value cmd`, go to bash
+        if argv and argv[0] not in SHELL_BUILTIN_NAMES and shutil.which(argv[0]) is not None:
+            return argv
+    return ["bash", "-c", script]
+
+
+def do_run_and_capture(code: str, thru_output=True, max_chars: Optional[int] = None) -> Tuple[int, str, str]:
+    """Run the code and capture the standard out and standard error.
+
+    With `max_chars`, output beyond what `clip_text(..., max_chars)` can keep is passed through but not stored.
+    """
+
+    import selectors
+    import subprocess
+
+    script = SHELL_PROMPT_PATTERN.sub("", code)
+    argv = command_argv(script)
+    bash_argv = ["bash", "-c", script]
+
+    # when a direct exec fails (e.g., a script without a shebang line), bash runs it or reports the exit code
+    if not thru_output:
+        try:
+            result = subprocess.run(argv, capture_output=True)
+        except OSError:
+            if argv == bash_argv:
+                raise
+            result = subprocess.run(bash_argv, capture_output=True)
+        return result.returncode, decode_output(result.stdout), decode_output(result.stderr)
+
+    try:
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        if argv == bash_argv:
+            raise
+        process = subprocess.Popen(bash_argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # a UTF-8 character takes at most 4 bytes; one more character tells clip_text that the text was longer
+    byte_limit = 4 * (max(max_chars, 0) + 1) if max_chars is not None else None
+
+    stdout_buf = bytearray()
+    stderr_buf = bytearray()
+    # whether anything but whitespace was dropped, by file descriptor; a dropped whitespace tail would be stripped anyway
+    truncated = {process.stdout.fileno(): False, process.stderr.fileno(): False}
+
+    # text printed before the command must come out before its output, which bypasses the text layer
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    with selectors.DefaultSelector() as sel:
+        for stream, buf, output in [(process.stdout, stdout_buf, sys.stdout), (process.stderr, stderr_buf, sys.stderr)]:
+            os.set_blocking(stream.fileno(), False)
+            sel.register(stream, selectors.EVENT_READ, (buf, output))
+
+        while sel.get_map():
+            for key, _ in sel.select():
+                try:
+                    data = os.read(key.fd, PIPE_READ_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                buf, output = key.data
+                if byte_limit is None:
+                    buf += data
+                else:
+                    kept = max(byte_limit + 1 - len(buf), 0)
+                    buf += data[:kept]
+                    truncated[key.fd] = truncated[key.fd] or bool(data[kept:].strip())
+                write_thru(output, data)
 
-    stdout = "".join(stdout_list).rstrip()
-    stderr = "".join(stderr_list).rstrip()
+    process.wait()
+    stdout_truncated = truncated[process.stdout.fileno()]
+    stderr_truncated = truncated[process.stderr.fileno()]
+    process.stdout.close()
+    process.stderr.close()
 
-    return process.returncode, stdout, stderr
+    return process.returncode, decode_output(stdout_buf, stdout_truncated), decode_output(stderr_buf, stderr_truncated)
 
 
-def highlight_and_extract_command(line_iter: Iterable[str], print_func: Callable[[str], None]) -> Optional[str]:
+def highlight_and_extract_command(
+    line_iter: Iterable[str], print_func: Callable[[str], None], colored: Callable[..., str]
+) -> Optional[str]:
     """Extract the first code block enclosed by "```" and add highlights to the text."""
 
+    highlight_prefix, highlight_suffix = color_affixes(colored, "green", attrs=["bold"])
+
+    line_iter = iter(line_iter)
     in_code_block = False
     code_block = []
-    pat_code_block_start = re.compile("^```")
-    pat_code_block_end = re.compile("^```")
 
     for line in line_iter:
         line = line.rstrip()
         if in_code_block:
-            if pat_code_block_start.match(line):
+            if line.startswith("```"):
                 print_func(line)
                 in_code_block = False
+                if code_block:  # an empty block does not count
+                    break
             else:
                 code_block.append(line)
-                print_func(colored(line, "green", attrs=["bold"]))
+                print_func(highlight_prefix + line + highlight_suffix)
         else:
             print_func(line)
-            if not code_block and pat_code_block_end.match(line):
+            if line.startswith("```"):
                 in_code_block = True
 
+    # the rest of the response, after the extracted code block, is printed as is
+    for line in line_iter:
+        print_func(line.rstrip())
+
     return "\n".join(code_block) if code_block else None
 
 
 def format_command_generation_prompt(
     task: str, context: Optional[str], generate_script: bool = False, prompting: Optional[str] = None
 ) -> str:
-    p = PROMPTINGS.get(prompting, "") if prompting is not None else ""
-    if generate_script:
-        p += f"Please provide a script to accomplish the following task."
-    else:
-        p += f"Please provide a command line to accomplish the following task."
-    if task:
-        p += f"\n## TASK\n{task}\n"
+    parts = [PROMPTINGS.get(prompting, "") if prompting is not None else ""]
+    parts.append(PROMPT_SCRIPT_REQUEST if generate_script else PROMPT_COMMAND_REQUEST)
+    # sections that tend to repeat across requests come first, so that the server can reuse the prompt prefix
     if context:
-        p += f"\n## CONTEXT\n{context}\n"
-    return p
+        parts += [PROMPT_CONTEXT_HEADER, context, "\n"]
+    if task:
+        parts += [PROMPT_TASK_HEADER, task, "\n"]
+    return "".join(parts)
 
 
 def format_analysis_prompt(
     code: str, task: Optional[str], context: Optional[str], stdout: Optional[str], stderr: Optional[str]
 ) -> str:
-    p = f"Analyze the result of the command.\n"
-    if task:
-        p += f"\n## TASK\n{task}\n"
+    parts = [PROMPT_ANALYSIS_REQUEST]
     if context:
-        p += f"\n## CONTEXT\n{context}\n"
-    p += f"\n## COMMAND\n```\n{code}\n```\n"
+        parts += [PROMPT_CONTEXT_HEADER, context, "\n"]
+    parts += [PROMPT_COMMAND_HEADER, code, "\n```\n"]
     if stdout:
-        p += f"\n## STDOUT\n{stdout}\n"
+        parts += [PROMPT_STDOUT_HEADER, stdout, "\n"]
     if stderr:
-        p += f"\n## STDERR\n{stderr}\n"
-
-    return p
+        parts += [PROMPT_STDERR_HEADER, stderr, "\n"]
+    if task:
+        parts += [PROMPT_TASK_HEADER, task, "\n"]
+    return "".join(parts)
 
 
 def build_reference_context(command: str, max_chars: int) -> str:
-    context = None
     exit_code, stdout, stderr = do_run_and_capture(command, thru_output=False)
-    r = ["```", f"$ {command}"]
-    if stdout:
-        r.append(clip_text(stdout, max_chars))
-    if stderr:
-        r.append(clip_text(stderr, max_chars))
-    if exit_code != 0:
-        r.append(f"EXIT CODE: {exit_code}")
-    r.append("```")
-    context = "\n".join(r)
-    return context
+    stdout_block = clip_text(stdout, max_chars) if stdout else ""
+    stderr_block = clip_text(stderr, max_chars) if stderr else ""
+    exit_block = f"EXIT CODE: {exit_code}\n" if exit_code != 0 else ""
+    return f"```\n$ {command}\n{stdout_block}{stderr_block}{exit_block}```"
+
 
+def print_flush(line: str) -> None:
+    print(line, flush=True)
 
-def line_it(stream) -> Iterable[str]:
-    buf = ""
+
+def text_it(stream) -> Iterator[str]:
+    get_message = operator.itemgetter("message")
+    get_content = operator.itemgetter("content")
     for chunk in stream:
-        buf += chunk['message']['content']
-        i = buf.find("\n")
-        while i >= 0:
-            yield buf[:i]
-            buf = buf[i + 1:]
-            i = buf.find("\n")
-    if buf:
-        if buf.endswith("\n"):
-            buf = buf[:-1]
-        yield buf
+        yield get_content(get_message(chunk))
+
+
+def line_it(text_iter: Iterable[str]) -> Iterator[str]:
+    pending: List[str] = []  # pieces of the current, not yet terminated line
+    for content in text_iter:
+        if "\n" not in content:
+            pending.append(content)
+            continue
+        lines = content.split("\n")
+        pending.append(lines[0])
+        yield "".join(pending)
+        yield from lines[1:-1]
+        pending = [lines[-1]]
+    tail = "".join(pending)
+    if tail:
+        yield tail
+
+
+def print_text_stream(text_iter: Iterable[str]) -> None:
+    """Print the text pieces as they arrive, ending the output with a newline."""
+
+    last = "\n"
+    for text in text_iter:
+        if text:
+            print(text, end="", flush=True)
+            last = text
+    if not last.endswith("\n"):
+        print(flush=True)
+
+
+@functools.lru_cache(maxsize=None)
+def ollama_client():
+    """Return the Ollama client shared by all requests in this process, so its connection is reused."""
+
+    try:
+        import ollama
+    except ImportError:
+        exit("Install `ollama-python` by following the instruction on: https://github.com/ollama/ollama-python")
+    return ollama.Client()
+
+
+def preload_model(client, model: str) -> None:
+    """Ask Ollama to load the model into memory, so that loading overlaps with other work."""
+
+    try:
+        client.chat(model=model, messages=[])
+    except Exception:
+        pass  # the actual chat request will report any problem
+
+
+def open_cache() -> Optional["sqlite3.Connection"]:
+    import sqlite3
+
+    try:
+        # the cache holds --refer command output, which may contain secrets, so keep it private
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        os.chmod(CACHE_DIR, 0o700)
+        os.close(os.open(CACHE_PATH, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(CACHE_PATH, 0o600)
+        conn = sqlite3.connect(CACHE_PATH)
+        conn.execute("PRAGMA secure_delete = ON")  # overwrite deleted rows instead of leaving them in free pages
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, ts INTEGER)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS contexts (key TEXT PRIMARY KEY, context TEXT, ts INTEGER)")
+        return conn
+    except (OSError, sqlite3.Error):
+        return None
+
+
+def cache_key(*fields: str) -> str:
+    import hashlib
+
+    return hashlib.sha256("\x00".join(fields).encode("utf-8")).hexdigest()
+
+
+def load_cached_response(conn: "sqlite3.Connection", key: str, ttl: int) -> Optional[List[str]]:
+    import sqlite3
+
+    try:
+        row = conn.execute(
+            "SELECT response FROM responses WHERE key = ? AND ts >= ?", (key, int(time.time()) - ttl)
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0].split("\n") if row is not None else None
+
+
+def store_response_lines(
+    conn: "sqlite3.Connection", key: str, model: str, ttl: int, line_iter: Iterable[str]
+) -> Iterator[str]:
+    """Pass the lines through, and save them to the cache once the response is complete."""
+
+    import sqlite3
+
+    lines = []
+    for L in line_iter:
+        lines.append(L)
+        yield L
+
+    if not lines:
+        return
+    now = int(time.time())
+    try:
+        with conn:
+            conn.execute("DELETE FROM responses WHERE ts < ?", (now - ttl,))
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, ts) VALUES (?, ?, ?, ?)",
+                (key, model, "\n".join(lines), now),
+            )
+    except sqlite3.Error:
+        pass
+
+
+def purge_expired_contexts(conn: "sqlite3.Connection", ttl: int) -> None:
+    import sqlite3
+
+    try:
+        with conn:
+            conn.execute("DELETE FROM contexts WHERE ts < ?", (int(time.time()) - max(ttl, 0),))
+    except sqlite3.Error:
+        pass
+
+
+def load_cached_context(conn: "sqlite3.Connection", key: str, ttl: int) -> Optional[str]:
+    import sqlite3
+
+    try:
+        row = conn.execute(
+            "SELECT context FROM contexts WHERE key = ? AND ts >= ?", (key, int(time.time()) - ttl)
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row is not None else None
+
+
+def store_cached_context(conn: "sqlite3.Connection", key: str, ttl: int, context: str) -> None:
+    import sqlite3
+
+    now = int(time.time())
+    try:
+        with conn:
+            conn.execute("DELETE FROM contexts WHERE ts < ?", (now - ttl,))
+            conn.execute("INSERT OR REPLACE INTO contexts (key, context, ts) VALUES (?, ?, ?)", (key, context, now))
+    except sqlite3.Error:
+        pass
 
 
 def main() -> None:
@@ -224,26 +471,93 @@ def main() -> None:
         default=DEFAULT_OUTPUT_MAX_CHARS,
         help="max characters of command execution results.",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="do not reuse or store LLM responses and --refer command output in the cache, and let the model sample its answer.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=DEFAULT_CACHE_TTL,
+        help="seconds a cached LLM response stays valid; 0 to disable the response cache (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--refer-ttl",
+        type=int,
+        default=DEFAULT_REFER_TTL,
+        help="seconds the output of a --refer command is reused in the same directory, "
+        "which may be stale as edited files are not detected; 0 to always run it (default: %(default)s).",
+    )
     parser.add_argument("-v", "--verbose", action="store_true")
-    parser.add_argument("--version", action="version", version=f"%(prog)s {_version}")
+    parser.add_argument("--version", action=VersionAction, help="show program's version number and exit")
     args = parser.parse_args()
 
     if not args.task:
         exit("Error: no task is given. Option `-h` for help.")
     task = " ".join(args.task)
 
+    if use_color(sys.stdout):
+        from termcolor import colored
+    else:
+        colored = no_color
+
     if args.verbose:
         print(colored(f"Model: {args.model}", attrs=["dark"]) + "\n", file=sys.stderr)
 
-    context = build_reference_context(args.refer, args.max_chars) if args.refer else None
+    cache = open_cache() if not args.no_cache else None
+    if cache is not None:
+        purge_expired_contexts(cache, args.refer_ttl)
+
+    def run_reference_command(command: str) -> str:
+        # load the model while the command runs; the thread is not waited for,
+        # a chat request sent meanwhile just waits for the model on the server side
+        threading.Thread(target=preload_model, args=(ollama_client(), args.model), daemon=True).start()
+        return build_reference_context(command, args.max_chars)
+
+    def cached_reference_context(command: str) -> str:
+        if cache is None or args.refer_ttl <= 0:
+            return run_reference_command(command)
+        # the directory's mtime changes when entries are added, removed, or renamed
+        key = cache_key(command, str(args.max_chars), os.getcwd(), str(os.stat(".").st_mtime_ns))
+        context = load_cached_context(cache, key, args.refer_ttl)
+        if args.verbose:
+            status = "hit" if context is not None else "miss"
+            print(colored(f"Refer cache: {status} ({key})", attrs=["dark"]) + "\n", file=sys.stderr)
+        if context is None:
+            context = run_reference_command(command)
+            store_cached_context(cache, key, args.refer_ttl, context)
+        return context
+
+    context = None
+    if args.refer:
+        context = cached_reference_context(args.refer)
 
-    def chat_stream_line_iter(p: str) -> Iterator[str]:
-        stream = ollama.chat(
+    def chat_stream_text_iter(p: str, options: Optional[Dict[str, float]] = None) -> Iterator[str]:
+        stream = ollama_client().chat(
             model=args.model,
             messages=[{"role": "user", "content": p}],
             stream=True,
+            options=options,
         )
-        return line_it(stream)
+        return text_it(stream)
+
+    def chat_stream_line_iter(p: str, options: Optional[Dict[str, float]] = None) -> Iterator[str]:
+        return line_it(chat_stream_text_iter(p, options))
+
+    def cached_chat_stream_line_iter(p: str) -> Iterator[str]:
+        if cache is None or args.prompt or args.cache_ttl <= 0:
+            return chat_stream_line_iter(p)
+        key = cache_key(args.model, p)
+        lines = load_cached_response(cache, key, args.cache_ttl)
+        if args.verbose:
+            status = "hit" if lines is not None else "miss"
+            print(colored(f"Response cache: {status} ({key})", attrs=["dark"]) + "\n", file=sys.stderr)
+        if lines is not None:
+            return iter(lines)
+        # only a deterministic response is worth replaying; a sampled one would pin a single, possibly bad, answer
+        line_iter = chat_stream_line_iter(p, CACHED_CHAT_OPTIONS)
+        return store_response_lines(cache, key, args.model, args.cache_ttl, line_iter)
 
     p = format_command_generation_prompt(
         task,
@@ -252,33 +566,32 @@ def main() -> None:
         prompting=args.prompt,
     )
     if args.verbose:
-        for L in p.split("\n"):
-            print(colored(L, attrs=["dark"]), file=sys.stderr)
+        print_prompt(p, colored)
 
     if args.prompt:
-        for L in chat_stream_line_iter(p):
-            print(L)
+        print_text_stream(chat_stream_text_iter(p))
         command = None
     else:
-        command = highlight_and_extract_command(chat_stream_line_iter(p), print)
+        command = highlight_and_extract_command(cached_chat_stream_line_iter(p), print_flush, colored)
 
     if command:
         if args.run:
             ht_run = colored(f"-- RUN", "yellow", attrs=["bold"])
             print(f"\n{ht_run}: {command}\n")
-            exit_code, stdout, stderr = do_run_and_capture(command)
+            exit_code, stdout, stderr = do_run_and_capture(command, max_chars=args.max_chars)
             if exit_code != 0:
                 print("\n" + colored("-- DEBUG", "yellow", attrs=["bold"]) + "\n")
                 p = format_analysis_prompt(
                     command, task, context, clip_text(stdout, args.max_chars), clip_text(stderr, args.max_chars)
                 )
                 if args.verbose:
-                    for L in p.split("\n"):
-                        print(colored(L, attrs=["dark"]), file=sys.stderr)
-                for L in chat_stream_line_iter(p):
-                    print(L)
+                    print_prompt(p, colored)
+                for L in cached_chat_stream_line_iter(p):
+                    print_flush(L)
             exit(exit_code)
         else:
+            import pyperclip
+
             pyperclip.copy(command)
             ht_copied = colored(f"-- COPIED THE HIGHLIGHTED CODE TO CLIPBOARD", "yellow", attrs=["bold"])
             print(f"\n{ht_copied}\n")